@@ -1,21 +1,21 @@
+import functools
 import logging
 import math
 import time
 from collections import defaultdict
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
-import cv2
 import numpy as np
 import opensfm.synthetic_data.synthetic_dataset as sd
 import scipy.signal as signal
 import scipy.spatial as spatial
 from opensfm import (
+    context,
     features as oft,
     geo,
     geometry,
     pygeometry,
     pymap,
-    reconstruction as rc,
     types,
 )
 from opensfm.types import Reconstruction
@@ -23,78 +23,86 @@ from opensfm.types import Reconstruction
 
 logger: logging.Logger = logging.getLogger(__name__)
 
+_rng: np.random.Generator = np.random.default_rng()
+
+
+def set_random_seed(seed: Optional[int]) -> None:
+    """Reset the random generator used to generate synthetic data."""
+    global _rng
+    _rng = np.random.default_rng(seed)
+
 
 def derivative(func: Callable, x: np.ndarray) -> np.ndarray:
-    eps = 1e-10
-    d = (func(x + eps) - func(x)) / eps
-    d /= np.linalg.norm(d)
+    """Unit tangents of `func` at each of the samples `x`, as a (N, 2) array.
+
+    Uses the analytic derivative of the known shape generators, and falls
+    back to finite differences for any other function.
+    """
+    analytic = None
+    if isinstance(func, functools.partial):
+        analytic = _analytic_derivatives.get(func.func)
+    if analytic is not None:
+        d = analytic(*func.args, x, **func.keywords)
+    else:
+        eps = 1e-10
+        d = (func(x + eps) - func(x)) / eps
+    d /= np.linalg.norm(d, axis=1, keepdims=True)
     return d
 
 
 def samples_generator_random_count(count: int) -> np.ndarray:
-    return np.random.rand(count)
+    return _rng.random(count)
 
 
 def samples_generator_interval(
     length: float, end: float, interval: float, interval_noise: float
 ) -> np.ndarray:
     samples = np.linspace(0, end / length, num=int(end / interval))
-    samples += np.random.normal(
-        0.0, float(interval_noise) / float(length), samples.shape
-    )
+    samples += _rng.normal(0.0, float(interval_noise) / float(length), samples.shape)
     return samples
 
 
 def generate_samples_and_local_frame(
     samples: np.ndarray, shape: Callable
 ) -> Tuple[np.ndarray, np.ndarray]:
-    points = []
-    tangents = []
-    for i in samples:
-        point = shape(i)
-        points += [point]
-        ex = derivative(shape, i)
-        ez = np.array([ex[1], -ex[0]])
-        tangents += [np.array([ez, ex])]
-    return np.array(points), np.array(tangents)
+    points = shape(samples)
+    ex = derivative(shape, samples)
+    ez = np.stack([ex[:, 1], -ex[:, 0]], axis=1)
+    tangents = np.stack([ez, ex], axis=1)
+    return points, tangents
 
 
 def generate_samples_shifted(
     samples: np.ndarray, shape: Callable, shift: float
 ) -> np.ndarray:
-    plane_points = []
-    for i in samples:
-        point = shape(i)
-        tangent = derivative(shape, i)
-        tangent = np.array([-tangent[1], tangent[0]])
-        point += tangent * (shift / 2)
-        plane_points += [point]
-    return np.array(plane_points)
+    points = shape(samples)
+    tangents = derivative(shape, samples)
+    normals = np.stack([-tangents[:, 1], tangents[:, 0]], axis=1)
+    return points + normals * (shift / 2)
 
 
 def generate_z_plane(
     samples: np.ndarray, shape: Callable, thickness: float
 ) -> np.ndarray:
-    plane_points = []
-    for i in samples:
-        point = shape(i)
-        tangent = derivative(shape, i)
-        tangent = np.array([-tangent[1], tangent[0]])
-        shift = tangent * ((np.random.rand() - 0.5) * thickness)
-        point += shift
-        plane_points += [point]
-    plane_points = np.array(plane_points)
-    return np.insert(plane_points, 2, values=0, axis=1)
+    points = shape(samples)
+    tangents = derivative(shape, samples)
+    normals = np.stack([-tangents[:, 1], tangents[:, 0]], axis=1)
+    shifts = (_rng.random((len(samples), 1)) - 0.5) * thickness
+    plane_points = np.empty((len(samples), 3))
+    plane_points[:, :2] = points + normals * shifts
+    plane_points[:, 2] = 0
+    return plane_points
 
 
 def generate_xy_planes(
     samples: np.ndarray, shape: Callable, z_size: float, y_size: float
 ) -> np.ndarray:
-    xy1 = generate_samples_shifted(samples, shape, y_size)
-    xy2 = generate_samples_shifted(samples, shape, -y_size)
-    xy1 = np.insert(xy1, 2, values=np.random.rand(xy1.shape[0]) * z_size, axis=1)
-    xy2 = np.insert(xy2, 2, values=np.random.rand(xy2.shape[0]) * z_size, axis=1)
-    return np.concatenate((xy1, xy2), axis=0)
+    n = len(samples)
+    planes = np.empty((2 * n, 3))
+    planes[:n, :2] = generate_samples_shifted(samples, shape, y_size)
+    planes[n:, :2] = generate_samples_shifted(samples, shape, -y_size)
+    planes[:, 2] = _rng.random(2 * n) * z_size
+    return planes
 
 
 def generate_street(
@@ -108,10 +116,17 @@ def generate_street(
 def generate_cameras(
     samples: np.ndarray, shape: Callable, height: float
 ) -> Tuple[np.ndarray, np.ndarray]:
-    positions, rotations = generate_samples_and_local_frame(samples, shape)
-    positions = np.insert(positions, 2, values=height, axis=1)
-    rotations = np.insert(rotations, 2, values=0, axis=2)
-    rotations = np.insert(rotations, 1, values=np.array([0, 0, -1]), axis=1)
+    positions_2d, tangents = generate_samples_and_local_frame(samples, shape)
+    n = len(samples)
+
+    positions = np.empty((n, 3))
+    positions[:, :2] = positions_2d
+    positions[:, 2] = height
+
+    rotations = np.zeros((n, 3, 3))
+    rotations[:, 0, :2] = tangents[:, 0]
+    rotations[:, 1, 2] = -1
+    rotations[:, 2, :2] = tangents[:, 1]
     return positions, rotations
 
 
@@ -119,30 +134,43 @@ def line_generator(
     length: float, center_x: float, center_y: float, transpose: bool, point: np.ndarray
 ) -> np.ndarray:
     x = point * length
+    y = np.full_like(x, center_y)
     if transpose:
-        return np.transpose(
-            np.array(
-                [
-                    center_y,
-                    x + center_x,
-                ]
-            )
-        )
+        return np.stack((y, x + center_x), axis=-1)
     else:
-        return np.transpose(np.array([x + center_x, center_y]))
+        return np.stack((x + center_x, y), axis=-1)
 
 
-def ellipse_generator(x_size: float, y_size: float, point: float) -> np.ndarray:
-    y = np.sin(point * 2 * np.pi) * y_size / 2
-    x = np.cos(point * 2 * np.pi) * x_size / 2
-    return np.transpose(np.array([x, y]))
+def ellipse_generator(x_size: float, y_size: float, point: np.ndarray) -> np.ndarray:
+    angle = point * 2 * np.pi
+    return np.stack((np.cos(angle) * x_size / 2, np.sin(angle) * y_size / 2), axis=-1)
 
 
-def perturb_points(points: np.ndarray, sigmas: List[float]) -> None:
+def line_generator_derivative(
+    length: float, center_x: float, center_y: float, transpose: bool, point: np.ndarray
+) -> np.ndarray:
+    d = np.zeros((len(point), 2))
+    d[:, 1 if transpose else 0] = length
+    return d
+
+
+def ellipse_generator_derivative(
+    x_size: float, y_size: float, point: np.ndarray
+) -> np.ndarray:
+    angle = point * 2 * np.pi
+    return np.stack([-np.sin(angle) * x_size, np.cos(angle) * y_size], axis=1) * np.pi
+
+
+_analytic_derivatives: Dict[Callable, Callable] = {
+    line_generator: line_generator_derivative,
+    ellipse_generator: ellipse_generator_derivative,
+}
+
+
+def perturb_points(points: np.ndarray, sigmas: Union[List[float], np.ndarray]) -> None:
     eps = 1e-10
-    gaussian = np.array([max(s, eps) for s in sigmas])
-    for point in points:
-        point += np.random.normal(0.0, gaussian, point.shape)
+    gaussian = np.maximum(np.asarray(sigmas, dtype=float), eps)
+    points += _rng.normal(0.0, gaussian, points.shape)
 
 
 def generate_causal_noise(
@@ -153,7 +181,7 @@ def generate_causal_noise(
     dist = np.linalg.norm(mesh, axis=0)
     filter_kernel = np.exp(-(dist**2) / (2 * scale))
 
-    noise = np.random.randn(dimensions, n) * sigma
+    noise = _rng.standard_normal((dimensions, n)) * sigma
     return signal.fftconvolve(noise, filter_kernel, mode="same")
 
 
@@ -193,79 +221,77 @@ def generate_exifs(
         exifs[shot_name] = exif
 
     speed_ms = 10.0
-    previous_pose = None
-    previous_time = 0
-    for rig_instance in sorted(
-        reconstruction.rig_instances.values(), key=lambda x: x.id
-    ):
-        pose = rig_instance.pose.get_origin()
-        if previous_pose is not None:
-            previous_time += np.linalg.norm(pose - previous_pose) / speed_ms
-        previous_pose = pose
+    rig_instances = sorted(reconstruction.rig_instances.values(), key=lambda x: x.id)
+    rig_origins = np.array([r.pose.get_origin() for r in rig_instances]).reshape(-1, 3)
+    capture_times = np.zeros(len(rig_instances))
+    capture_times[1:] = (
+        np.cumsum(np.linalg.norm(np.diff(rig_origins, axis=0), axis=1)) / speed_ms
+    )
+    for rig_instance, capture_time in zip(rig_instances, capture_times):
         for shot_id in rig_instance.shots:
-            exifs[shot_id]["capture_time"] = previous_time
+            exifs[shot_id]["capture_time"] = capture_time
 
     for sequence_images in per_sequence.values():
+        shots = [reconstruction.shots[shot_name] for shot_name in sequence_images]
+        origins = np.array([shot.pose.get_origin() for shot in shots])
+        rotations = np.array([shot.pose.get_rotation_matrix() for shot in shots])
+
+        gps_perturbations = np.zeros((len(shots), 3))
         if causal_gps_noise:
-            sequence_gps_dop = _gps_dop(reconstruction.shots[sequence_images[0]])
+            sequence_gps_dop = _gps_dop(shots[0])
             perturbations_2d = generate_causal_noise(
-                2, sequence_gps_dop, len(sequence_images), 2.0
+                2, sequence_gps_dop, len(shots), 2.0
             )
-        for i, shot_name in enumerate(sequence_images):
-            shot = reconstruction.shots[shot_name]
+            gps_perturbations[:, :2] = np.transpose(perturbations_2d)
+        else:
+            gps_dops = np.array([_gps_dop(shot) for shot in shots])
+            gps_perturbations[:, 0] = gps_dops
+            gps_perturbations[:, 1] = gps_dops
+        perturb_points(origins, gps_perturbations)
+        latitudes, longitudes, altitudes = reference.to_lla(*origins.T)
+
+        # compass angle of the optical axis, as in reconstruction.shot_lla_and_compass
+        optical_axes = rotations[:, 2]
+        compasses = np.rad2deg(np.arctan2(optical_axes[:, 0], optical_axes[:, 1]))
+        compasses = (compasses + 360) % 360
+
+        opk_noises = _rng.normal(0.0, imu_noise, (len(shots), 3))
+        for i, (shot_name, shot) in enumerate(zip(sequence_images, shots)):
             exif = exifs[shot_name]
 
-            origin = shot.pose.get_origin()
-
-            if causal_gps_noise:
-                gps_perturbation = [perturbations_2d[j][i] for j in range(2)] + [0]
-            else:
-                gps_noise = _gps_dop(shot)
-                gps_perturbation = [gps_noise, gps_noise, 0]
-
-            origin = np.array([origin])
-            perturb_points(origin, gps_perturbation)
-            origin = origin[0]
-            _, _, _, comp = rc.shot_lla_and_compass(shot, reference)
-            lat, lon, alt = reference.to_lla(*origin)
-
             exif["gps"] = {}
-            exif["gps"]["latitude"] = lat
-            exif["gps"]["longitude"] = lon
-            exif["gps"]["altitude"] = alt
+            exif["gps"]["latitude"] = latitudes[i]
+            exif["gps"]["longitude"] = longitudes[i]
+            exif["gps"]["altitude"] = altitudes[i]
             exif["gps"]["dop"] = _gps_dop(shot)
 
-            omega, phi, kappa = geometry.opk_from_rotation(
-                shot.pose.get_rotation_matrix()
-            )
-            opk_noise = np.random.normal(0.0, np.full((3), imu_noise), (3))
+            omega, phi, kappa = geometry.opk_from_rotation(rotations[i])
+            opk_noise = opk_noises[i]
             exif["opk"] = {}
             exif["opk"]["omega"] = math.degrees(omega) + opk_noise[0]
             exif["opk"]["phi"] = math.degrees(phi) + opk_noise[1]
             exif["opk"]["kappa"] = math.degrees(kappa) + opk_noise[2]
 
-            exif["compass"] = {"angle": comp}
+            exif["compass"] = {"angle": compasses[i]}
 
     return exifs
 
 
 def perturb_rotations(rotations: np.ndarray, angle_sigma: float) -> None:
-    for i in range(len(rotations)):
-        rotation = rotations[i]
-        rodrigues = cv2.Rodrigues(rotation)[0].ravel()
-        angle = np.linalg.norm(rodrigues)
-        angle_pertubed = angle + np.random.normal(0.0, angle_sigma)
-        rodrigues *= float(angle_pertubed) / float(angle)
-        rotations[i] = cv2.Rodrigues(rodrigues)[0]
+    rodrigues = spatial.transform.Rotation.from_matrix(rotations).as_rotvec()
+    angles = np.linalg.norm(rodrigues, axis=1)
+    angles_perturbed = angles + _rng.normal(0.0, angle_sigma, angles.shape)
+    rodrigues *= (angles_perturbed / np.where(angles > 0, angles, 1.0))[:, np.newaxis]
+    rotations[:] = spatial.transform.Rotation.from_rotvec(rodrigues).as_matrix()
 
 
 def add_points_to_reconstruction(
     points: np.ndarray, color: np.ndarray, reconstruction: types.Reconstruction
 ) -> None:
     shift = len(reconstruction.points)
-    for i in range(points.shape[0]):
-        point = reconstruction.create_point(str(shift + i), points[i, :])
-        point.color = color
+    create_point = reconstruction.create_point
+    for i, coordinates in enumerate(points, start=shift):
+        create_point(str(i), coordinates).color = color
 
 
 def add_shots_to_reconstruction(
@@ -346,12 +372,16 @@ def generate_track_data(
     gcps_count: Optional[int],
     gcp_shift: Optional[np.ndarray],
     on_disk_features_filename: Optional[str],
+    processes: int = 1,
 ) -> Tuple[
     sd.SyntheticFeatures, pymap.TracksManager, Dict[str, pymap.GroundControlPoint]
 ]:
     """Generate projection data from a reconstruction, considering a maximum
     viewing depth and gaussian noise added to the ideal projections.
     Returns feature/descriptor/color data per shot and a tracks manager object.
+
+    Shots are projected in parallel using `processes` threads, while the
+    tracks manager and the features are filled serially.
     """
 
     tracks_manager = pymap.TracksManager()
@@ -361,100 +391,110 @@ def generate_track_data(
     non_zeroes = 5
 
     points_ids = list(reconstruction.points)
-    points_coordinates = [p.coordinates for p in reconstruction.points.values()]
-    points_colors = [p.color for p in reconstruction.points.values()]
+    points = list(reconstruction.points.values())
+    points_coordinates = np.array(
+        [p.coordinates for p in points], dtype=np.float64
+    ).reshape(-1, 3)
+    points_colors = np.array([p.color for p in points])
 
     # generate random descriptors per point
-    track_descriptors = []
-    for _ in points_coordinates:
-        descriptor = np.zeros(desc_size)
-        for _ in range(non_zeroes):
-            index = np.random.randint(0, desc_size)
-            descriptor[index] = np.random.random() * 255
-        track_descriptors.append(descriptor.round().astype(feature_data_type))
+    track_descriptors = np.zeros((len(points), desc_size), dtype=feature_data_type)
+    descriptors_indices = _rng.integers(0, desc_size, (len(points), non_zeroes))
+    descriptors_values = _rng.random((len(points), non_zeroes)) * 255
+    np.put_along_axis(
+        track_descriptors, descriptors_indices, descriptors_values.round(), axis=1
+    )
 
     # should speed-up projection queries
     points_tree = spatial.cKDTree(points_coordinates)
-
-    start = time.time()
-    features = sd.SyntheticFeatures(on_disk_features_filename)
     default_scale = 0.004
-    for index, (shot_index, shot) in enumerate(reconstruction.shots.items()):
+
+    def project_shot(
+        args: Tuple[pymap.Shot, int],
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        shot, seed = args
+
+        # shot constants
+        pose, camera = shot.pose, shot.camera
+        center = pose.get_origin()
+        is_panorama = pygeometry.Camera.is_panorama(camera.projection_type)
+        perturbation = float(projection_noise) / float(max(camera.width, camera.height))
+
         # query all closest points
-        neighbors = list(
-            sorted(points_tree.query_ball_point(shot.pose.get_origin(), maximum_depth))
+        neighbors = np.array(
+            sorted(points_tree.query_ball_point(center, maximum_depth)), dtype=int
         )
 
         # project them
-        projections = shot.project_many(
-            np.array([points_coordinates[c] for c in neighbors])
+        neighbors_coordinates = points_coordinates[neighbors]
+        projections = shot.project_many(neighbors_coordinates)
+
+        # check valid projections
+        valid = _is_inside_camera(projections, camera)
+        if not is_panorama:
+            z_axis = pose.get_rotation_matrix()[2]
+            valid &= _is_in_front(neighbors_coordinates, center, z_axis)
+
+        # gather data of valid projections and perturb them
+        ids_inside = neighbors[valid]
+        points_inside = np.empty((len(ids_inside), 3))
+        points_inside[:, :2] = projections[valid]
+        points_inside[:, :2] += np.random.default_rng(seed).normal(
+            0.0, perturbation, (len(ids_inside), 2)
         )
+        points_inside[:, 2] = default_scale
+        descriptors_inside = track_descriptors[ids_inside]
+        colors_inside = points_colors[ids_inside]
+        return ids_inside, points_inside, descriptors_inside, colors_inside
 
-        # shot constants
-        center = shot.pose.get_origin()
-        z_axis = shot.pose.get_rotation_matrix()[2]
-        is_panorama = pygeometry.Camera.is_panorama(shot.camera.projection_type)
-        perturbation = float(projection_noise) / float(
-            max(shot.camera.width, shot.camera.height)
-        )
-        sigmas = np.array([perturbation, perturbation])
-
-        # pre-generate random perturbations
-        perturbations = np.random.normal(0.0, sigmas, (len(projections), 2))
-
-        # run and check valid projections
-        projections_inside = []
-        descriptors_inside = []
-        colors_inside = []
-        for i, (p_id, projection) in enumerate(zip(neighbors, projections)):
-            if not _is_inside_camera(projection, shot.camera):
-                continue
-
-            point = points_coordinates[p_id]
-            if not is_panorama and not _is_in_front(point, center, z_axis):
-                continue
-
-            # add perturbation
-            projection += perturbations[i]
-
-            # push data
-            color = points_colors[p_id]
-            original_id = points_ids[p_id]
-            projections_inside.append([projection[0], projection[1], default_scale])
-            descriptors_inside.append(track_descriptors[p_id])
-            colors_inside.append(color)
-            obs = pymap.Observation(
-                projection[0],
-                projection[1],
-                default_scale,
-                color[0],
-                color[1],
-                color[2],
-                len(projections_inside) - 1,
-            )
-            tracks_manager.add_observation(str(shot_index), str(original_id), obs)
-        features[shot_index] = oft.FeaturesData(
-            np.array(projections_inside),
-            np.array(descriptors_inside),
-            np.array(colors_inside),
-            None,
+    # per-shot seeds keep the noise reproducible regardless of threading
+    shots = list(reconstruction.shots.items())
+    seeds = _rng.integers(np.iinfo(np.int64).max, size=len(shots))
+
+    start = time.time()
+    features = sd.SyntheticFeatures(on_disk_features_filename)
+    flush_size = 100
+    for batch_start in range(0, len(shots), flush_size):
+        batch = shots[batch_start : batch_start + flush_size]
+        batch_seeds = seeds[batch_start : batch_start + flush_size]
+        results = context.parallel_map(
+            project_shot,
+            [(s, seed) for (_, s), seed in zip(batch, batch_seeds)],
+            processes,
         )
 
-        if index % 100 == 0:
-            logger.info(
-                f"Flushing images # {index} ({(time.time() - start)/(index+1)} sec. per image"
+        for (shot_index, _), shot_data in zip(batch, results):
+            ids_inside, points_inside, descriptors_inside, colors_inside = shot_data
+
+            # push observations, point ids are already strings
+            shot_id = str(shot_index)
+            for feature_id, (p_id, (x, y, scale), (r, g, b)) in enumerate(
+                zip(ids_inside.tolist(), points_inside.tolist(), colors_inside.tolist())
+            ):
+                obs = pymap.Observation(x, y, scale, r, g, b, feature_id)
+                tracks_manager.add_observation(shot_id, points_ids[p_id], obs)
+            features[shot_index] = oft.FeaturesData(
+                points_inside,
+                descriptors_inside,
+                colors_inside,
+                None,
             )
-            features.sync()
+
+        index = batch_start + len(batch)
+        logger.info(
+            f"Flushing images # {index} ({(time.time() - start)/index} sec. per image"
+        )
+        features.sync()
 
     gcps = {}
     if gcps_count is not None and gcp_shift is not None:
         all_track_ids = list(tracks_manager.get_track_ids())
         gcps_ids = [
             all_track_ids[i]
-            for i in np.random.randint(len(all_track_ids) - 1, size=gcps_count)
+            for i in _rng.integers(len(all_track_ids) - 1, size=gcps_count)
         ]
 
-        sigmas_gcp = np.random.normal(
+        sigmas_gcp = _rng.normal(
             0.0,
             np.array([gcp_noise[0], gcp_noise[0], gcp_noise[1]]),
             (len(gcps_ids), 3),
@@ -479,19 +519,16 @@ def generate_track_data(
     return features, tracks_manager, gcps
 
 
-def _is_in_front(point: np.ndarray, center: np.ndarray, z_axis: np.ndarray) -> bool:
-    return (
-        (point[0] - center[0]) * z_axis[0]
-        + (point[1] - center[1]) * z_axis[1]
-        + (point[2] - center[2]) * z_axis[2]
-    ) > 0
+def _is_in_front(
+    points: np.ndarray, center: np.ndarray, z_axis: np.ndarray
+) -> np.ndarray:
+    return (points - center).dot(z_axis) > 0
 
 
-def _is_inside_camera(projection: np.ndarray, camera: pygeometry.Camera) -> bool:
+def _is_inside_camera(projections: np.ndarray, camera: pygeometry.Camera) -> np.ndarray:
     w, h = float(camera.width), float(camera.height)
-    w2 = float(2 * camera.width)
-    h2 = float(2 * camera.height)
     if w > h:
-        return (-0.5 < projection[0] < 0.5) and (-h / w2 < projection[1] < h / w2)
+        max_x, max_y = 0.5, h / (2 * w)
     else:
-        return (-0.5 < projection[1] < 0.5) and (-w / h2 < projection[0] < w / h2)
+        max_x, max_y = w / (2 * h), 0.5
+    return (np.abs(projections[:, 0]) < max_x) & (np.abs(projections[:, 1]) < max_y)
@@ -433,6 +433,7 @@ class SyntheticInputData:
         gcps_shift: Optional[np.ndarray] = None,
         on_disk_features_filename: Optional[str] = None,
         generate_projections: bool = True,
+        processes: int = 1,
     ) -> None:
         self.reconstruction = reconstruction
         self.exifs = sg.generate_exifs(
@@ -452,6 +453,7 @@ class SyntheticInputData:
                 gcps_count,
                 gcps_shift,
                 on_disk_features_filename,
+                processes,
             )
         else:
             self.features = sd.SyntheticFeatures(None)
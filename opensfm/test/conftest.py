@@ -9,6 +9,7 @@ from opensfm.synthetic_data import (
     synthetic_examples,
     synthetic_scene,
     synthetic_dataset as sd,
+    synthetic_generator,
 )
 
 
@@ -31,6 +32,7 @@ def null_scene() -> types.Reconstruction:
 @pytest.fixture(scope="module")
 def scene_synthetic() -> synthetic_scene.SyntheticInputData:
     np.random.seed(42)
+    synthetic_generator.set_random_seed(42)
     reference = geo.TopocentricConverter(47.0, 6.0, 0)
     data = synthetic_examples.synthetic_circle_scene(reference)
 
@@ -60,6 +62,7 @@ def scene_synthetic() -> synthetic_scene.SyntheticInputData:
 @pytest.fixture(scope="session")
 def scene_synthetic_cube() -> Tuple[types.Reconstruction, pymap.TracksManager]:
     np.random.seed(42)
+    synthetic_generator.set_random_seed(42)
     data = synthetic_examples.synthetic_cube_scene()
 
     reference = geo.TopocentricConverter(47.0, 6.0, 0)
@@ -73,6 +76,7 @@ def scene_synthetic_cube() -> Tuple[types.Reconstruction, pymap.TracksManager]:
 @pytest.fixture(scope="module")
 def scene_synthetic_rig() -> synthetic_scene.SyntheticInputData:
     np.random.seed(42)
+    synthetic_generator.set_random_seed(42)
     reference = geo.TopocentricConverter(47.0, 6.0, 0)
     data = synthetic_examples.synthetic_rig_scene(reference)
 
@@ -97,6 +101,7 @@ def scene_synthetic_rig() -> synthetic_scene.SyntheticInputData:
 @pytest.fixture(scope="module")
 def scene_synthetic_triangulation() -> synthetic_scene.SyntheticInputData:
     np.random.seed(42)
+    synthetic_generator.set_random_seed(42)
     reference = geo.TopocentricConverter(47.0, 6.0, 0)
     data = synthetic_examples.synthetic_circle_scene(reference)
 
@@ -133,6 +138,7 @@ def pairs_and_poses() -> Tuple[
     types.Reconstruction,
 ]:
     np.random.seed(42)
+    synthetic_generator.set_random_seed(42)
     data = synthetic_examples.synthetic_cube_scene()
 
     reconstruction = data.get_reconstruction()